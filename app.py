@@ -1,40 +1,235 @@
 import os
+import time
+import collections
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 import pytz
 from flask import Flask, request, jsonify, send_file, render_template, session, redirect, Response ,url_for
-from azure.data.tables import TableServiceClient
-import pandas as pd
-from io import BytesIO
-from reportlab.platypus import SimpleDocTemplate, Table
-from reportlab.lib.pagesizes import letter
+from flask.json.provider import JSONProvider
+import orjson
+from azure.data.tables import TableServiceClient, UpdateMode, TableTransactionError, TableErrorCode
+import csv
+import zlib
+from io import BytesIO, StringIO
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import letter, landscape
+from math import ceil
 import json
 from functools import wraps
 
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = "super-secret-key"
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 
+# =========================
+# Time Config
+# =========================
+IST = pytz.timezone("Asia/Kolkata")
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def format_rowkey(dt):
+    """Format dt as a RowKey, YYYYmmddHHMMSSffffff (strftime "%Y%m%d%H%M%S%f")"""
+    return (
+        f"{dt.year:04d}{dt.month:02d}{dt.day:02d}"
+        f"{dt.hour:02d}{dt.minute:02d}{dt.second:02d}{dt.microsecond:06d}"
+    )
+
+
+def format_timestamp(dt):
+    """Format dt as TIMESTAMP_FORMAT without going through strftime"""
+    return (
+        f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} "
+        f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+    )
+
+
 # =========================
 # Azure Table Config
 # =========================
 TABLES_CONN = os.environ.get("TABLES_CONNECTION_STRING")
 TABLE_NAME = os.environ.get("TABLE_NAME", "DeviceData")
 TABLE_NAME_2 = os.environ.get("TABLE_NAME_2", "ScadaData")
+# Device reported on when a request does not name one
+REPORT_DEVICE_ID = os.environ.get("REPORT_DEVICE_ID", "susanmpa")
+# Report queries are split into up to this many time windows run in parallel
+REPORT_QUERY_WORKERS = int(os.environ.get("REPORT_QUERY_WORKERS", 8))
 
 service = TableServiceClient.from_connection_string(TABLES_CONN)
 table_client = service.get_table_client(TABLE_NAME)
 table_client_2 = service.get_table_client(TABLE_NAME_2)
 
+_query_executor = ThreadPoolExecutor(max_workers=REPORT_QUERY_WORKERS)
+
 try:
     table_client.create_table()
     table_client_2.create_table()
 except:
     pass
 
+# =========================
+# Batched Writes
+# =========================
+# Max entities per transaction (Azure limit is 100 per PartitionKey)
+BATCH_MAX = int(os.environ.get("BATCH_MAX", 100))
+# Max time an entity waits in the buffer before it is flushed
+BATCH_WAIT_MS = int(os.environ.get("BATCH_WAIT_MS", 500))
+# Transactions for different partitions are sent in parallel
+FLUSH_WORKERS = int(os.environ.get("FLUSH_WORKERS", 8))
+# Max entities buffered or in flight; beyond this ingest answers 503
+BUFFER_MAX = int(os.environ.get("BUFFER_MAX", 10000))
+
+# (table_client, PartitionKey) -> [entity, ...]
+_pending = {}
+# Entities accepted but not yet written (buffered or in flight)
+_buffered = 0
+_pending_lock = threading.Lock()
+_flush_executor = ThreadPoolExecutor(max_workers=FLUSH_WORKERS)
+
+
+def submit_batch(client, entities):
+    """Upsert a list of same-partition entities in one transaction
+
+    If the service rejects one operation, that entity is dropped and the
+    rest are resubmitted; any other failure drops the batch.
+    """
+    global _buffered
+    count = len(entities)
+
+    try:
+        while entities:
+            try:
+                client.submit_transaction(
+                    [("upsert", e, {"mode": UpdateMode.REPLACE}) for e in entities]
+                )
+                break
+            except TableTransactionError as e:
+                if (
+                    e.status_code in (413, 429, 503)
+                    or getattr(e, "error_code", None) == TableErrorCode.SERVER_BUSY
+                    or not 0 <= e.index < len(entities)
+                ):
+                    raise
+                bad = entities[e.index]
+                print(f"Write error ({client.table_name}, {bad['PartitionKey']}/{bad['RowKey']}): {e.message}")
+                entities = entities[:e.index] + entities[e.index + 1:]
+    except Exception as e:
+        print(f"Batch write error ({client.table_name}, {len(entities)} entities): {e}")
+    finally:
+        with _pending_lock:
+            _buffered -= count
+
+
+def enqueue_entity(client, entity):
+    """Buffer an entity, flushing its partition once BATCH_MAX is reached
+
+    Returns False without buffering when BUFFER_MAX entities are already
+    waiting to be written.
+    """
+    global _buffered
+    key = (client, entity["PartitionKey"])
+
+    with _pending_lock:
+        if _buffered >= BUFFER_MAX:
+            return False
+        _buffered += 1
+        batch = _pending.setdefault(key, [])
+        batch.append(entity)
+        if len(batch) < BATCH_MAX:
+            return True
+        del _pending[key]
+
+    try:
+        _flush_executor.submit(submit_batch, client, batch)
+    except RuntimeError:
+        # Executor already shut down (interpreter exit)
+        submit_batch(client, batch)
+    return True
+
+
+def flush_pending(executor=None):
+    """Write out every buffered partition, concurrently if given an executor"""
+    with _pending_lock:
+        batches = list(_pending.items())
+        _pending.clear()
+
+    if executor is None:
+        for (client, _), batch in batches:
+            submit_batch(client, batch)
+        return
+
+    futures = []
+    for (client, _), batch in batches:
+        try:
+            futures.append(executor.submit(submit_batch, client, batch))
+        except RuntimeError:
+            # Executor already shut down (interpreter exit)
+            submit_batch(client, batch)
+    wait(futures)
+
+
+def batch_flusher():
+    while True:
+        time.sleep(BATCH_WAIT_MS / 1000)
+        try:
+            flush_pending(_flush_executor)
+        except Exception as e:
+            print(f"Batch flush error: {e}")
+
+
+threading.Thread(target=batch_flusher, daemon=True).start()
+atexit.register(flush_pending)
+
 # =========================
 # In-Memory Cache (Device Wise)
 # =========================
-latest_cache = {}
+# Least recently updated devices are evicted beyond MAX_DEVICES
+MAX_DEVICES = int(os.environ.get("MAX_DEVICES", 10000))
+# Devices that have not reported for this long are dropped
+LATEST_TTL_SECONDS = int(os.environ.get("LATEST_TTL_SECONDS", 3600))
+
+# PartitionKey -> (monotonic time of update, entity), oldest update first;
+# the order is only used for eviction
+latest_cache = collections.OrderedDict()
+_latest_lock = threading.Lock()
+
+
+def cache_latest(entity):
+    """Store the latest entity for its device"""
+    pk = entity["PartitionKey"]
+    with _latest_lock:
+        latest_cache[pk] = (time.monotonic(), entity)
+        latest_cache.move_to_end(pk)
+        if len(latest_cache) > MAX_DEVICES:
+            latest_cache.popitem(last=False)
+        prune_latest()
+
+
+def prune_latest():
+    """Drop devices whose latest entity is older than LATEST_TTL_SECONDS
+
+    Callers must hold _latest_lock.
+    """
+    expiry = time.monotonic() - LATEST_TTL_SECONDS
+    while latest_cache:
+        pk, (updated, _) = next(iter(latest_cache.items()))
+        if updated >= expiry:
+            break
+        latest_cache.pop(pk, None)
 
 # Login decorator
 def login_required(f):
@@ -96,75 +291,102 @@ def reports():
 # =========================
 # BUILD ENTITY
 # =========================
+# Payload value types stored without conversion
+NATIVE_VALUE_TYPES = frozenset((str, float, bool, type(None)))
+
 def build_entity(data):
 
     deviceid = str(data.get("deviceid", "susanad"))
 
-    ist = pytz.timezone("Asia/Kolkata")
-    ist_time = datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(ist)
+    ist_time = datetime.now(IST)
 
     # ✅ FIX 1 — Unique RowKey
-    rowkey = ist_time.strftime("%Y%m%d%H%M%S%f")
+    rowkey = format_rowkey(ist_time)
 
-    ts = ist_time.strftime("%Y-%m-%d %H:%M:%S")
+    ts = format_timestamp(ist_time)
 
-    entity = {
-        "PartitionKey": deviceid,
-        "RowKey": rowkey,
-        "TimestampIST": ts
-    }
+    # Copy the payload as is; numbers and booleans are stored as native Edm types
+    entity = data.copy()
+    entity.pop("deviceid", None)
 
-    for k, v in data.items():
-        if k != "deviceid":
+    # Only values Azure cannot store directly need converting
+    for k, v in entity.items():
+        if type(v) in NATIVE_VALUE_TYPES:
+            continue
+        if isinstance(v, (dict, list)):
+            entity[k] = json.dumps(v)
+        elif type(v) is int and not -2**31 <= v < 2**31:
+            # Python ints are sent as Edm.Int32, so keep larger ones as text
             entity[k] = str(v)
 
+    entity["PartitionKey"] = deviceid
+    entity["RowKey"] = rowkey
+    entity["TimestampIST"] = ts
+
     return entity
 
 
 # =========================
 # INGEST API (SCADA)
 # =========================
+def read_json_body():
+    """Parse the raw request body as a JSON object, returning (data, error response)"""
+    raw = request.get_data(cache=False)
+    if not raw:
+        return None, (jsonify({"error": "JSON required"}), 400)
+
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return None, (jsonify({"error": "Invalid JSON"}), 400)
+
+    if not isinstance(data, dict):
+        return None, (jsonify({"error": "JSON object required"}), 400)
+
+    return data, None
+
+
 @app.route("/ingest", methods=["POST"])
 def ingest():
 
-    if not request.is_json:
-        return jsonify({"error": "JSON required"}), 400
-
-    data = request.get_json()
+    data, error = read_json_body()
+    if error:
+        return error
 
     try:
         entity = build_entity(data)
 
-        table_client.upsert_entity(entity=entity, mode="replace")
+        if not enqueue_entity(table_client, entity):
+            return jsonify({"error": "Write buffer full, retry later"}), 503, {"Retry-After": "1"}
 
         # ✅ FIX 2 — Multi Device Cache
-        latest_cache[entity["PartitionKey"]] = entity
+        cache_latest(entity)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-    return jsonify({"status": "ok"})
+    return jsonify({"status": "accepted"}), 202
 
 @app.route("/load", methods=["POST"])
 def load_data():
 
-    if not request.is_json:
-        return jsonify({"error": "JSON required"}), 400
-
-    data = request.get_json()
+    data, error = read_json_body()
+    if error:
+        return error
 
     try:
         entity = build_entity(data)
 
-        table_client_2.upsert_entity(entity=entity, mode="replace")
+        if not enqueue_entity(table_client_2, entity):
+            return jsonify({"error": "Write buffer full, retry later"}), 503, {"Retry-After": "1"}
 
         # ✅ FIX 2 — Multi Device Cache
-        latest_cache[entity["PartitionKey"]] = entity
+        cache_latest(entity)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-    return jsonify({"status": "ok"})
+    return jsonify({"status": "accepted"}), 202
 
 
 # =========================
@@ -173,7 +395,13 @@ def load_data():
 @app.route("/api/latest")
 @login_required
 def latest():
-    return jsonify(list(latest_cache.values()))
+    with _latest_lock:
+        prune_latest()
+        devices = list(latest_cache.items())
+    
+    # Stable device order for the dashboard (cache order is update recency)
+    devices.sort()
+    return jsonify([entity for _, (_, entity) in devices])
 
 # =========================
 # Fuel Consumption API
@@ -183,14 +411,14 @@ def api_readings():
 
     from_time = request.args.get("fromTime")
     to_time = request.args.get("toTime")
-    deviceid = "susanmpa"
+    deviceid = REPORT_DEVICE_ID
 
     if not from_time or not to_time:
         return jsonify({"error": "fromTime and toTime required"}), 400
 
     try:
-        start_dt = datetime.strptime(from_time, "%Y-%m-%d %H:%M:%S")
-        end_dt = datetime.strptime(to_time, "%Y-%m-%d %H:%M:%S")
+        start_dt = datetime.strptime(from_time, TIMESTAMP_FORMAT)
+        end_dt = datetime.strptime(to_time, TIMESTAMP_FORMAT)
     except:
         return jsonify({"error": "Invalid datetime format"}), 400
 
@@ -198,14 +426,12 @@ def api_readings():
 
     try:
 
-        # Azure optimized query
-        query = (
-            f"PartitionKey eq '{deviceid}' "
-            f"and TimestampIST ge '{from_time}' "
-            f"and TimestampIST le '{to_time}'"
-        )
-
-        entities = list(table_client_2.query_entities(query))
+        # Azure optimized query, fetching only the mass flow columns used below
+        entities = list(table_client_2.query_entities(
+            "PartitionKey eq @pk and TimestampIST ge @lo and TimestampIST le @hi",
+            parameters={"pk": deviceid, "lo": from_time, "hi": to_time},
+            select=["TimestampIST"] + [f"FT{i}MassFlow" for i in range(1, 10)]
+        ))
 
         current_start = start_dt
 
@@ -231,7 +457,7 @@ def api_readings():
                     continue
 
                 try:
-                    ts_dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+                    ts_dt = datetime.strptime(ts, TIMESTAMP_FORMAT)
                 except:
                     continue
 
@@ -309,23 +535,50 @@ def api_readings():
 
 # Add these imports at the top if not already present
 from io import BytesIO
-import pandas as pd
 from datetime import datetime
 from functools import wraps
 
 def parse_dt(value):
     """Parse datetime string to datetime object"""
     try:
-        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
     except ValueError:
         try:
             return datetime.strptime(value, "%Y-%m-%d %H:%M")
         except ValueError:
             return datetime.strptime(value.replace('T', ' '), "%Y-%m-%d %H:%M")
 
-def fetch_engine_consumption(engine_type, start, end, interval='hour'):
+def query_time_range(deviceid, start_dt, end_dt, columns):
+    """Fetch a device's entities between start_dt and end_dt (inclusive, to the second)
+
+    RowKey is the IST timestamp (format_rowkey), so the range is filtered
+    server side. Ranges over an hour are split into contiguous RowKey
+    windows that are queried in parallel; rows come back in time order.
+    """
+    start_dt = start_dt.replace(microsecond=0)
+    stop_dt = end_dt.replace(microsecond=0) + timedelta(seconds=1)
+    span = stop_dt - start_dt
+    
+    windows = max(1, min(REPORT_QUERY_WORKERS, int(span.total_seconds() // 3600)))
+    step = span / windows
+    bounds = [format_rowkey(start_dt + i * step) for i in range(windows)]
+    bounds.append(format_rowkey(stop_dt))
+    
+    def query_window(lo, hi):
+        return list(table_client_2.query_entities(
+            "PartitionKey eq @pk and RowKey ge @lo and RowKey lt @hi",
+            parameters={"pk": deviceid, "lo": lo, "hi": hi},
+            select=columns
+        ))
+    
+    return [
+        e
+        for window in _query_executor.map(query_window, bounds[:-1], bounds[1:])
+        for e in window
+    ]
+
+def fetch_engine_consumption(engine_type, start, end, interval='hour', deviceid=REPORT_DEVICE_ID):
     """Fetch engine consumption data based on engine type"""
-    deviceid = "susanmpa"
     
     # Define meter pairs for each engine type
     engine_config = {
@@ -372,24 +625,21 @@ def fetch_engine_consumption(engine_type, start, end, interval='hour'):
         print(f"Date parsing error: {e}")
         return None
     
-    # Query all entities
-    query = f"PartitionKey eq '{deviceid}'"
-    entities = list(table_client_2.query_entities(query))
-    print(f"Total entities found: {len(entities)}")
-    
-    # Filter entities by time range
-    filtered_entities = []
-    for e in entities:
-        ts = e.get("TimestampIST")
-        if not ts:
-            continue
-        try:
-            ts_dt = parse_dt(ts)
-            if start_dt <= ts_dt <= end_dt:
-                filtered_entities.append(e)
-        except:
-            continue
+    # Only fetch the columns this engine type needs
+    if engine_type == 'consumpution':
+        meters = [config['meter']]
+    else:
+        meters = [config['inlet'], config['outlet']]
+    columns = ["TimestampIST"] + [
+        meter + field
+        for meter in meters
+        for field in ("MassFlow", "Masstotal", "Volumetotal", "Density", "Temp")
+    ]
     
+    filtered_entities = [
+        e for e in query_time_range(deviceid, start_dt, end_dt, columns)
+        if e.get("TimestampIST")
+    ]
     print(f"Filtered entities: {len(filtered_entities)}")
     
     if not filtered_entities:
@@ -403,8 +653,27 @@ def fetch_engine_consumption(engine_type, start, end, interval='hour'):
             'interval': interval
         }
     
-    # Sort entities by timestamp
-    filtered_entities.sort(key=lambda x: x.get('TimestampIST', ''))
+    # Entity property and record field names, built once per report
+    if engine_type != 'consumpution':
+        inlet, outlet = config['inlet'], config['outlet']
+        inlet_keys = tuple(inlet + f for f in ("Volumetotal", "Masstotal", "Temp", "Density"))
+        outlet_keys = tuple(outlet + f for f in ("Volumetotal", "Masstotal", "Temp", "Density"))
+        inlet_vol_field, inlet_mass_field, inlet_temp_field, inlet_density_field = (
+            f"{inlet}_{f}" for f in ("VolumeTotal", "MassFlow", "Temp", "Density")
+        )
+        outlet_vol_field, outlet_mass_field, outlet_temp_field, outlet_density_field = (
+            f"{outlet}_{f}" for f in ("VolumeTotal", "MassFlow", "Temp", "Density")
+        )
+    
+    # TimestampIST is TIMESTAMP_FORMAT, so every interval key is a prefix of it
+    interval_key_length = {
+        'minute': 16,
+        'hour': 13,
+        'daily': 10,
+        'monthly': 7,
+        'yearly': 4
+    }.get(interval)
+    interval_key_suffix = ":00" if interval == 'hour' else ""
     
     # Process records based on engine type
     records = []
@@ -412,7 +681,6 @@ def fetch_engine_consumption(engine_type, start, end, interval='hour'):
     
     for e in filtered_entities:
         ts = e.get("TimestampIST")
-        ts_dt = parse_dt(ts)
         
         # Debug: Print first record to see available fields
         if len(records) == 0:
@@ -434,35 +702,23 @@ def fetch_engine_consumption(engine_type, start, end, interval='hour'):
             ft9_temp = float(e.get("FT9Temp", 0) or 0)
             ft9_density = float(e.get("FT9Density", 0) or 0)
         else:
-            # Engine consumption (Inlet - Outlet)
-            inlet_vol = float(e.get(config['inlet'] + "Volumetotal", 0) or 0)
-            outlet_vol = float(e.get(config['outlet'] + "Volumetotal", 0) or 0)
+            # Engine consumption (Inlet - Outlet), plus mass, temp and density
+            inlet_vol, inlet_massflow, inlet_temp, inlet_density = [
+                float(e.get(k, 0) or 0) for k in inlet_keys
+            ]
+            outlet_vol, outlet_massflow, outlet_temp, outlet_density = [
+                float(e.get(k, 0) or 0) for k in outlet_keys
+            ]
             consumption = inlet_vol - outlet_vol
             
-            # Get other fields
-            inlet_massflow = float(e.get(config['inlet'] + "Masstotal", 0) or 0)
-            outlet_massflow = float(e.get(config['outlet'] + "Masstotal", 0) or 0)
-            inlet_temp = float(e.get(config['inlet'] + "Temp", 0) or 0)
-            outlet_temp = float(e.get(config['outlet'] + "Temp", 0) or 0)
-            inlet_density = float(e.get(config['inlet'] + "Density", 0) or 0)
-            outlet_density = float(e.get(config['outlet'] + "Density", 0) or 0)
-            
             record_data = {
-                f"{config['inlet']}_VolumeTotal": inlet_vol,
-                f"{config['outlet']}_VolumeTotal": outlet_vol
+                inlet_vol_field: inlet_vol,
+                outlet_vol_field: outlet_vol
             }
         
         # Determine interval key
-        if interval == 'minute':
-            interval_key = ts_dt.strftime("%Y-%m-%d %H:%M")
-        elif interval == 'hour':
-            interval_key = ts_dt.strftime("%Y-%m-%d %H:00")
-        elif interval == 'daily':
-            interval_key = ts_dt.strftime("%Y-%m-%d")
-        elif interval == 'monthly':
-            interval_key = ts_dt.strftime("%Y-%m")
-        elif interval == 'yearly':
-            interval_key = ts_dt.strftime("%Y")
+        if interval_key_length:
+            interval_key = ts[:interval_key_length] + interval_key_suffix
         else:
             interval_key = ts
         
@@ -478,12 +734,12 @@ def fetch_engine_consumption(engine_type, start, end, interval='hour'):
         # Add additional fields based on engine type
         if engine_type != 'consumpution':
             record.update({
-                f"{config['inlet']}_MassFlow": round(inlet_massflow, 5),
-                f"{config['outlet']}_MassFlow": round(outlet_massflow, 5),
-                f"{config['inlet']}_Temp": round(inlet_temp, 2),
-                f"{config['outlet']}_Temp": round(outlet_temp, 2),
-                f"{config['inlet']}_Density": round(inlet_density, 2),
-                f"{config['outlet']}_Density": round(outlet_density, 2),
+                inlet_mass_field: round(inlet_massflow, 5),
+                outlet_mass_field: round(outlet_massflow, 5),
+                inlet_temp_field: round(inlet_temp, 2),
+                outlet_temp_field: round(outlet_temp, 2),
+                inlet_density_field: round(inlet_density, 2),
+                outlet_density_field: round(outlet_density, 2),
                 "InletValue": round(inlet_vol, 5),
                 "OutletValue": round(outlet_vol, 5)
             })
@@ -550,14 +806,14 @@ def fetch_engine_consumption(engine_type, start, end, interval='hour'):
             
             if engine_type != 'consumpution':
                 agg_record.update({
-                    f"{config['inlet']}_VolumeTotal": round(agg['total_inlet'], 5),
-                    f"{config['outlet']}_VolumeTotal": round(agg['total_outlet'], 5),
-                    f"{config['inlet']}_MassFlow": round(agg['total_inlet_mass'] / count, 5),
-                    f"{config['outlet']}_MassFlow": round(agg['total_outlet_mass'] / count, 5),
-                    f"{config['inlet']}_Temp": round(agg['total_inlet_temp'] / count, 2),
-                    f"{config['outlet']}_Temp": round(agg['total_outlet_temp'] / count, 2),
-                    f"{config['inlet']}_Density": round(agg['total_inlet_density'] / count, 2),
-                    f"{config['outlet']}_Density": round(agg['total_outlet_density'] / count, 2)
+                    inlet_vol_field: round(agg['total_inlet'], 5),
+                    outlet_vol_field: round(agg['total_outlet'], 5),
+                    inlet_mass_field: round(agg['total_inlet_mass'] / count, 5),
+                    outlet_mass_field: round(agg['total_outlet_mass'] / count, 5),
+                    inlet_temp_field: round(agg['total_inlet_temp'] / count, 2),
+                    outlet_temp_field: round(agg['total_outlet_temp'] / count, 2),
+                    inlet_density_field: round(agg['total_inlet_density'] / count, 2),
+                    outlet_density_field: round(agg['total_outlet_density'] / count, 2)
                 })
             else:
                 agg_record.update({
@@ -596,6 +852,7 @@ def download_csv():
         start = request.args.get("start", "").replace("T", " ")
         end = request.args.get("end", "").replace("T", " ")
         interval = request.args.get("interval", "hour")
+        deviceid = request.args.get("deviceid", REPORT_DEVICE_ID)
         
         if not start or not end:
             return jsonify({"error": "Start and end time required"}), 400
@@ -603,16 +860,13 @@ def download_csv():
         print(f"CSV Request - Engine: {engine_type}, Interval: {interval}, Start: {start}, End: {end}")
         
         # Fetch data based on engine type
-        result = fetch_engine_consumption(engine_type, start, end, interval)
+        result = fetch_engine_consumption(engine_type, start, end, interval, deviceid)
         
         if not result:
             return jsonify({"error": "Invalid engine type"}), 400
         
-        # Create DataFrame from records
         if result['records']:
-            df = pd.DataFrame(result['records'])
-            
-            # Reorder columns based on engine type and interval
+            # Order columns based on engine type and interval
             base_columns = ['Timestamp', 'Interval', 'EngineType', 'EngineName']
             
             if engine_type == 'consumpution':
@@ -636,48 +890,117 @@ def download_csv():
                 base_columns.append('RecordCount')
             
             column_order = base_columns + value_columns
-            column_order = [col for col in column_order if col in df.columns]
-            df = df[column_order]
+            column_order = [col for col in column_order if col in result['records'][0]]
+            
+            # The summary row always carries RecordCount
+            if 'RecordCount' not in column_order:
+                column_order.append('RecordCount')
             
-            # Add summary row
+            rows = result['records']
             summary = {
                 'EngineType': 'SUMMARY',
                 'EngineName': result['name'],
                 'Consumption': result['total_consumption'],
                 'RecordCount': result['record_count']
             }
-            
-            # Fill missing columns in summary
-            for col in column_order:
-                if col not in summary and col not in ['Timestamp', 'Interval']:
-                    summary[col] = ''
-            
-            df = pd.concat([df, pd.DataFrame([summary])], ignore_index=True)
         else:
-            df = pd.DataFrame([{
+            column_order = ['Timestamp', 'EngineType', 'EngineName', 'Message']
+            rows = []
+            summary = {
                 'Timestamp': 'No data found',
                 'EngineType': engine_type,
-                'EngineName': result['name'] if result else engine_type,
+                'EngineName': result['name'],
                 'Message': f'No records found for {engine_type} from {start} to {end}'
-            }])
+            }
+        
+        def generate():
+            # Write rows straight to the response, one at a time
+            buffer = StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=column_order, extrasaction='ignore')
+            
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            
+            writer.writerow(summary)
+            yield buffer.getvalue()
+        
+        def generate_gzip():
+            # Compress the CSV stream incrementally (wbits=31 writes a gzip container)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            for chunk in generate():
+                data = compressor.compress(chunk.encode("utf-8"))
+                if data:
+                    yield data
+            yield compressor.flush()
+        
+        # Generate filename
+        filename = f"{engine_type}_{interval}_{start.replace(' ', '_')}_to_{end.replace(' ', '_')}.csv"
+        headers = {
+            "Content-Disposition": f"attachment; filename=\"{filename}\"",
+            "Vary": "Accept-Encoding"
+        }
+        
+        if request.accept_encodings["gzip"] > 0:
+            headers["Content-Encoding"] = "gzip"
+            return Response(generate_gzip(), mimetype="text/csv", headers=headers)
+        
+        return Response(generate(), mimetype="text/csv", headers=headers)
+        
+    except Exception as e:
+        print(f"CSV download error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/download_parquet")
+@login_required
+def download_parquet():
+    """Download Parquet report for selected engine"""
+    try:
+        # Only this report needs pyarrow, so keep it out of app startup
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        # Get parameters
+        engine_type = request.args.get("type", "PME")
+        start = request.args.get("start", "").replace("T", " ")
+        end = request.args.get("end", "").replace("T", " ")
+        interval = request.args.get("interval", "hour")
+        deviceid = request.args.get("deviceid", REPORT_DEVICE_ID)
         
-        # Create CSV
+        if not start or not end:
+            return jsonify({"error": "Start and end time required"}), 400
+        
+        # Fetch data
+        result = fetch_engine_consumption(engine_type, start, end, interval, deviceid)
+        
+        if not result:
+            return jsonify({"error": "Invalid engine type"}), 400
+        
+        if not result['records']:
+            return jsonify({"error": f"No records found for {engine_type} from {start} to {end}"}), 404
+        
+        # Columnar, typed output for analytics consumers
+        table = pa.Table.from_pylist(result['records'])
         output = BytesIO()
-        df.to_csv(output, index=False)
+        pq.write_table(table, output, compression="zstd")
         output.seek(0)
         
         # Generate filename
-        filename = f"{engine_type}_{interval}_{start.replace(' ', '_')}_to_{end.replace(' ', '_')}.csv"
+        filename = f"{engine_type}_{interval}_{start.replace(' ', '_')}_to_{end.replace(' ', '_')}.parquet"
         
         return send_file(
             output,
-            mimetype="text/csv",
+            mimetype="application/vnd.apache.parquet",
             download_name=filename,
             as_attachment=True
         )
         
     except Exception as e:
-        print(f"CSV download error: {e}")
+        print(f"Parquet download error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
@@ -876,22 +1199,18 @@ def download_csv():
 def download_pdf():
     """Download PDF report for selected engine"""
     try:
-        from reportlab.lib.pagesizes import letter, landscape
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.utils import simpleSplit
-        from math import ceil
-        
         # Get parameters
         engine_type = request.args.get("type", "PME")
         start = request.args.get("start", "").replace("T", " ")
         end = request.args.get("end", "").replace("T", " ")
         interval = request.args.get("interval", "hour")
+        deviceid = request.args.get("deviceid", REPORT_DEVICE_ID)
         
         if not start or not end:
             return jsonify({"error": "Start and end time required"}), 400
         
         # Fetch data
-        result = fetch_engine_consumption(engine_type, start, end, interval)
+        result = fetch_engine_consumption(engine_type, start, end, interval, deviceid)
         
         if not result:
             return jsonify({"error": "Invalid engine type"}), 400
@@ -1007,39 +1326,56 @@ def download_pdf():
             c.setFont("Helvetica", 12)
             c.drawString(50, 450, "No data found for selected date range")
         else:
-            # Table headers - expanded to include running totals
-            y = 500
-            c.setFont("Helvetica-Bold", 6)  # Even smaller font to fit all columns
-            
+            # Table layout: (header, x position, record field, number format)
             if engine_type == 'consumpution':
-                c.drawString(50, y, "Timestamp")
-                c.drawString(120, y, "FT9 Vol")
-                c.drawString(170, y, "Consumption")
-                c.drawString(220, y, "Diff")
-                c.drawString(270, y, "Run Mass")
-                c.drawString(320, y, "Run Vol")
-                c.drawString(370, y, "Mass Flow")
-                c.drawString(420, y, "Temp")
-                c.drawString(470, y, "Density")
+                columns = [
+                    ("FT9 Vol", 120, 'FT9_VolumeTotal', "{:.2f}"),
+                    ("Consumption", 170, 'Consumption', "{:.2f}"),
+                    ("Diff", 220, 'Consumption_Difference', "{:.2f}"),
+                    ("Run Mass", 270, 'RunningTotalMass', "{:.2f}"),
+                    ("Run Vol", 320, 'RunningTotalVolume', "{:.2f}"),
+                    ("Mass Flow", 370, 'FT9_MassFlow', "{:.2f}"),
+                    ("Temp", 420, 'FT9_Temp', "{:.1f}"),
+                    ("Density", 470, 'FT9_Density', "{:.2f}")
+                ]
             else:
-                c.drawString(50, y, "Timestamp")
-                c.drawString(110, y, "In Vol")
-                c.drawString(160, y, "Out Vol")
-                c.drawString(210, y, "Consumption")
-                c.drawString(260, y, "Diff")
-                c.drawString(310, y, "Run Mass")
-                c.drawString(360, y, "Run Vol")
-                c.drawString(410, y, "In Mass")
-                c.drawString(460, y, "Out Mass")
-                c.drawString(510, y, "In Temp")
-                c.drawString(560, y, "Out Temp")
+                columns = [
+                    ("In Vol", 110, f"{cfg['inlet']}_VolumeTotal", "{:.2f}"),
+                    ("Out Vol", 160, f"{cfg['outlet']}_VolumeTotal", "{:.2f}"),
+                    ("Consumption", 210, 'Consumption', "{:.2f}"),
+                    ("Diff", 260, 'Consumption_Difference', "{:.2f}"),
+                    ("Run Mass", 310, 'RunningTotalMass', "{:.2f}"),
+                    ("Run Vol", 360, 'RunningTotalVolume', "{:.2f}"),
+                    ("In Mass", 410, f"{cfg['inlet']}_MassFlow", "{:.2f}"),
+                    ("Out Mass", 460, f"{cfg['outlet']}_MassFlow", "{:.2f}"),
+                    ("In Temp", 510, f"{cfg['inlet']}_Temp", "{:.1f}"),
+                    ("Out Temp", 560, f"{cfg['outlet']}_Temp", "{:.1f}")
+                ]
+            
+            headers = ["Timestamp"] + [header for header, _, _, _ in columns]
+            positions = [50] + [x for _, x, _, _ in columns]
+            
+            # Format every row to strings in a single pass
+            table_rows = [
+                [str(record.get('Timestamp', ''))[5:16]]
+                + [fmt.format(record.get(field, 0)) for _, _, field, fmt in columns]
+                for record in result['records']
+            ]
+            
+            def draw_row(y, row):
+                for x, text in zip(positions, row):
+                    c.drawString(x, y, text)
+            
+            y = 500
+            c.setFont("Helvetica-Bold", 6)  # Small font to fit all columns
+            draw_row(y, headers)
             
             y -= 15
             c.setFont("Helvetica", 5.5)
             
             # Calculate pages needed
             records_per_page = 20  # Fewer records per page due to more columns
-            total_pages = ceil(len(result['records']) / records_per_page)
+            total_pages = ceil(len(table_rows) / records_per_page)
             
             for page in range(total_pages):
                 if page > 0:
@@ -1048,101 +1384,18 @@ def download_pdf():
                     c.setFont("Helvetica-Bold", 6)
                     c.drawString(50, y, f"{result['name']} - Page {page+1}/{total_pages}")
                     y -= 20
-                    c.setFont("Helvetica-Bold", 6)
                     
                     # Repeat headers
-                    if engine_type == 'consumpution':
-                        c.drawString(50, y, "Timestamp")
-                        c.drawString(120, y, "FT9 Vol")
-                        c.drawString(170, y, "Consumption")
-                        c.drawString(220, y, "Diff")
-                        c.drawString(270, y, "Run Mass")
-                        c.drawString(320, y, "Run Vol")
-                        c.drawString(370, y, "Mass Flow")
-                        c.drawString(420, y, "Temp")
-                        c.drawString(470, y, "Density")
-                    else:
-                        c.drawString(50, y, "Timestamp")
-                        c.drawString(110, y, "In Vol")
-                        c.drawString(160, y, "Out Vol")
-                        c.drawString(210, y, "Consumption")
-                        c.drawString(260, y, "Diff")
-                        c.drawString(310, y, "Run Mass")
-                        c.drawString(360, y, "Run Vol")
-                        c.drawString(410, y, "In Mass")
-                        c.drawString(460, y, "Out Mass")
-                        c.drawString(510, y, "In Temp")
-                        c.drawString(560, y, "Out Temp")
+                    draw_row(y, headers)
                     
                     y -= 15
                     c.setFont("Helvetica", 5.5)
                 
-                page_records = result['records'][page * records_per_page:(page + 1) * records_per_page]
-                
-                for record in page_records:
+                for row in table_rows[page * records_per_page:(page + 1) * records_per_page]:
                     if y < 50:
                         break
                     
-                    if engine_type == 'consumpution':
-                        c.drawString(50, y, str(record.get('Timestamp', ''))[5:16])
-                        c.drawString(120, y, f"{record.get('FT9_VolumeTotal', 0):.2f}")
-                        c.drawString(170, y, f"{record.get('Consumption', 0):.2f}")
-                        c.drawString(220, y, f"{record.get('Consumption_Difference', 0):.2f}")
-                        c.drawString(270, y, f"{record.get('RunningTotalMass', 0):.2f}")
-                        c.drawString(320, y, f"{record.get('RunningTotalVolume', 0):.2f}")
-                        c.drawString(370, y, f"{record.get('FT9_MassFlow', 0):.2f}")
-                        c.drawString(420, y, f"{record.get('FT9_Temp', 0):.1f}")
-                        c.drawString(470, y, f"{record.get('FT9_Density', 0):.2f}")
-                    else:
-                        if engine_type == 'PME':
-                            c.drawString(50, y, str(record.get('Timestamp', ''))[5:16])
-                            c.drawString(110, y, f"{record.get('FT1_VolumeTotal', 0):.2f}")
-                            c.drawString(160, y, f"{record.get('FT2_VolumeTotal', 0):.2f}")
-                            c.drawString(210, y, f"{record.get('Consumption', 0):.2f}")
-                            c.drawString(260, y, f"{record.get('Consumption_Difference', 0):.2f}")
-                            c.drawString(310, y, f"{record.get('RunningTotalMass', 0):.2f}")
-                            c.drawString(360, y, f"{record.get('RunningTotalVolume', 0):.2f}")
-                            c.drawString(410, y, f"{record.get('FT1_MassFlow', 0):.2f}")
-                            c.drawString(460, y, f"{record.get('FT2_MassFlow', 0):.2f}")
-                            c.drawString(510, y, f"{record.get('FT1_Temp', 0):.1f}")
-                            c.drawString(560, y, f"{record.get('FT2_Temp', 0):.1f}")
-                        elif engine_type == 'SME':
-                            c.drawString(50, y, str(record.get('Timestamp', ''))[5:16])
-                            c.drawString(110, y, f"{record.get('FT3_VolumeTotal', 0):.2f}")
-                            c.drawString(160, y, f"{record.get('FT4_VolumeTotal', 0):.2f}")
-                            c.drawString(210, y, f"{record.get('Consumption', 0):.2f}")
-                            c.drawString(260, y, f"{record.get('Consumption_Difference', 0):.2f}")
-                            c.drawString(310, y, f"{record.get('RunningTotalMass', 0):.2f}")
-                            c.drawString(360, y, f"{record.get('RunningTotalVolume', 0):.2f}")
-                            c.drawString(410, y, f"{record.get('FT3_MassFlow', 0):.2f}")
-                            c.drawString(460, y, f"{record.get('FT4_MassFlow', 0):.2f}")
-                            c.drawString(510, y, f"{record.get('FT3_Temp', 0):.1f}")
-                            c.drawString(560, y, f"{record.get('FT4_Temp', 0):.1f}")
-                        elif engine_type == 'PAE':
-                            c.drawString(50, y, str(record.get('Timestamp', ''))[5:16])
-                            c.drawString(110, y, f"{record.get('FT5_VolumeTotal', 0):.2f}")
-                            c.drawString(160, y, f"{record.get('FT6_VolumeTotal', 0):.2f}")
-                            c.drawString(210, y, f"{record.get('Consumption', 0):.2f}")
-                            c.drawString(260, y, f"{record.get('Consumption_Difference', 0):.2f}")
-                            c.drawString(310, y, f"{record.get('RunningTotalMass', 0):.2f}")
-                            c.drawString(360, y, f"{record.get('RunningTotalVolume', 0):.2f}")
-                            c.drawString(410, y, f"{record.get('FT5_MassFlow', 0):.2f}")
-                            c.drawString(460, y, f"{record.get('FT6_MassFlow', 0):.2f}")
-                            c.drawString(510, y, f"{record.get('FT5_Temp', 0):.1f}")
-                            c.drawString(560, y, f"{record.get('FT6_Temp', 0):.1f}")
-                        elif engine_type == 'SAE':
-                            c.drawString(50, y, str(record.get('Timestamp', ''))[5:16])
-                            c.drawString(110, y, f"{record.get('FT7_VolumeTotal', 0):.2f}")
-                            c.drawString(160, y, f"{record.get('FT8_VolumeTotal', 0):.2f}")
-                            c.drawString(210, y, f"{record.get('Consumption', 0):.2f}")
-                            c.drawString(260, y, f"{record.get('Consumption_Difference', 0):.2f}")
-                            c.drawString(310, y, f"{record.get('RunningTotalMass', 0):.2f}")
-                            c.drawString(360, y, f"{record.get('RunningTotalVolume', 0):.2f}")
-                            c.drawString(410, y, f"{record.get('FT7_MassFlow', 0):.2f}")
-                            c.drawString(460, y, f"{record.get('FT8_MassFlow', 0):.2f}")
-                            c.drawString(510, y, f"{record.get('FT7_Temp', 0):.1f}")
-                            c.drawString(560, y, f"{record.get('FT8_Temp', 0):.1f}")
-                    
+                    draw_row(y, row)
                     y -= 12
         
         c.save()